@@ -4,151 +4,452 @@
 import argparse
 import json
 import logging
+import math
+import re
 import sys
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timezone
+from itertools import groupby, islice
+from operator import itemgetter
 
 import cassandra
 import cassandra.cluster
-from cassandra.query import dict_factory
+from cassandra.concurrent import (execute_concurrent,
+                                  execute_concurrent_with_args)
+from cassandra.policies import DCAwareRoundRobinPolicy, TokenAwarePolicy
+from cassandra.query import SimpleStatement, bind_params, dict_factory
+from cassandra.util import SortedSet
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def escape_row(value):
-    try:
-        json.dumps(value)
-        return value
-    except TypeError:
-        return str(value)
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
 
+DEFAULT_PARALLEL_TABLES = 16
+DEFAULT_CONCURRENCY = 128
+CUSTOM_QUERIES = "custom_queries"
+SKIP_KEYSPACE_PREFIXES = ("system", "dse_", "OpsCenter", "HiveMetaStore")
+SKIP_KEYSPACES = frozenset(["cfs", "cfs_archive", "dsefs", "solr_admin"])
 
-def get_table_data_from_template(session, table, table_template):
+
+def get_table_data_from_template(session, table, table_template,
+                                 concurrency=DEFAULT_CONCURRENCY):
     """Return sample rows present in table_template"""
     logging.debug("Loading data for queries from template")
     row_list = table_template.get("data")
     if row_list is None:
         return None
-    current_data = []
     if row_list:
-        for row_data in row_list:
-            query = row_data["query"]
-            result = session.execute(query)
-            current_data.append({
-                "query": query,
-                "data": [escape_row(r) for r in result]
-            })
+        queries = [row_data["query"] for row_data in row_list]
+        statements = [(SimpleStatement(q), ()) for q in queries]
+        results = execute_concurrent(session, statements,
+                                     concurrency=concurrency,
+                                     results_generator=True)
+        current_data = [{"query": query, "data": list(result)}
+                        for query, (_, result) in zip(queries, results)]
     else:
-        current_data = get_table_data_from_db(session, table, 1)
+        current_data = get_table_data_from_db(session, table, 1,
+                                              concurrency)
     logging.info(current_data)
     return current_data
 
 
-def build_response_for_row(session, table, row):
-    """Store query and result into a dictionary"""
-    table_name = table.keyspace_name + "." + table.name
-    pk = [p.name for p in table.primary_key]
-    predicate = " and ".join(["%s = %%(%s)s" % (n, n) for n in pk])
-    query = "SELECT * FROM {} WHERE {}".format(
-        table_name,
-        predicate
-        )
-    logging.debug(query)
-    params = {k: row[k] for k in pk}
-    logging.debug(params)
-    future = session.execute_async(query, params)
-    bounded_query = future.message.query
-    logging.debug(bounded_query)
-    rows2 = future.result()
-    return {
-        "query": bounded_query,
-        "data": [escape_row(r) for r in rows2]
-        }
-
-
-def get_table_data_from_db(session, table, sample_size):
+_prepared_queries = {}
+
+
+def prepare_row_query(session, table_name, pk):
+    """Return query template and prepared statement selecting a row by key
+
+    Statements are prepared once per session and table and reused for
+    later calls, a statement is only known to the cluster it was
+    prepared on.
+    """
+    key = (session, table_name)
+    if key not in _prepared_queries:
+        predicate = " and ".join(f"{n} = %s" for n in pk)
+        query = f"SELECT * FROM {table_name} WHERE {predicate}"
+        logging.debug(query)
+        predicate = " and ".join(f"{n} = ?" for n in pk)
+        statement = session.prepare(
+            f"SELECT * FROM {table_name} WHERE {predicate}")
+        _prepared_queries[key] = (query, statement)
+    return _prepared_queries[key]
+
+
+def build_responses(session, query, params_list, results):
+    """Store bound queries and their results into dictionaries"""
+    encoder = session.encoder
+    responses = []
+    for params, (_, result) in zip(params_list, results):
+        bounded_query = bind_params(query, params, encoder)
+        logging.debug(bounded_query)
+        responses.append({"query": bounded_query, "data": list(result)})
+    return responses
+
+
+def get_table_data_from_db(session, table, sample_size,
+                           concurrency=DEFAULT_CONCURRENCY):
     """Extract sample_size rows from database"""
     logging.debug("Loading sample rows from database")
-    table_name = table.keyspace_name + "." + table.name
+    table_name = f"{table.keyspace_name}.{table.name}"
+    # check mode samples no new rows, tables missing in template differ
+    if sample_size is None or sample_size < 1:
+        return []
+    # a single page holds the whole sample, further pages are never fetched
+    statement = SimpleStatement(f"SELECT * FROM {table_name}",
+                                fetch_size=sample_size)
     try:
-        rows = session.execute("SELECT * FROM " + table_name + " LIMIT %s",
-                               [sample_size])
+        rows = list(islice(session.execute(statement), sample_size))
     except cassandra.ReadFailure:
         logging.warning("Cannot acquire data from %s. Too many tombstones?",
                         table_name)
         return None
-    data = []
-    for row in rows:
-        data.append(build_response_for_row(session, table, row))
-    return data
+    if not rows:
+        return []
+    pk = tuple(p.name for p in table.primary_key)
+    query, statement = prepare_row_query(session, table_name, pk)
+    params_list = [tuple(row[k] for k in pk) for row in rows]
+    results = execute_concurrent_with_args(session, statement, params_list,
+                                           concurrency=concurrency,
+                                           results_generator=True)
+    return build_responses(session, query, params_list, results)
 
 
 def get_table_fingerprint(session, table, sample_size, table_template,
-                          transient_tables):
+                          transient_tables, concurrency=DEFAULT_CONCURRENCY):
     """ Extract table definition and some data into dictionary"""
     logging.info("Generating fingerprint of table %s", table.name)
     fingerprint = {}
     fingerprint["schema"] = table.export_as_string()
     if table_template:
-        data = get_table_data_from_template(session, table, table_template)
-    elif table.keyspace_name + "." + table.name in transient_tables:
+        data = get_table_data_from_template(session, table, table_template,
+                                            concurrency)
+    elif f"{table.keyspace_name}.{table.name}" in transient_tables:
         logging.info("Skipping generation of data fingerprint")
         data = None
     else:
-        data = get_table_data_from_db(session, table, sample_size)
+        data = get_table_data_from_db(session, table, sample_size,
+                                      concurrency)
     if data is not None:
         fingerprint["data"] = data
     return fingerprint
 
 
-def generate_fingerprint_for_kp(session, keyspace, sample_size, ksp_template,
-                                transient_tables):
-    """ Prepare fingerprint of a keyspace"""
-    logging.info("Generating fingerprint of keyspace %s", keyspace.name)
-    fingerprint = {}
-    for table in keyspace.tables.values():
-        table_template = ksp_template.get(table.name)
-        fingerprint[table.name] = get_table_fingerprint(session,
-                                                        table,
-                                                        sample_size,
-                                                        table_template,
-                                                        transient_tables
-                                                        )
-    return fingerprint
+def schedule_table_fingerprints(executor, session, tables, sample_size,
+                                transient_tables, window,
+                                concurrency=DEFAULT_CONCURRENCY):
+    """Yield (keyspace name, table name, fingerprint) in order of tables
+
+    tables holds (keyspace name, table, template) entries, a None table
+    marks a keyspace without tables and is passed through as is. At most
+    window tables are fingerprinted ahead of the consumer, so finished
+    fingerprints do not pile up in memory.
+    """
+    pending = deque()
+    current_keyspace = None
+    for keyspace_name, table, table_template in tables:
+        if keyspace_name != current_keyspace:
+            logging.info("Generating fingerprint of keyspace %s",
+                         keyspace_name)
+            current_keyspace = keyspace_name
+        if table is None:
+            pending.append((keyspace_name, None, None))
+        else:
+            pending.append((keyspace_name, table.name,
+                            executor.submit(get_table_fingerprint,
+                                            session,
+                                            table,
+                                            sample_size,
+                                            table_template,
+                                            transient_tables,
+                                            concurrency
+                                            )))
+        if len(pending) >= window:
+            yield resolve_table_fingerprint(*pending.popleft())
+    while pending:
+        yield resolve_table_fingerprint(*pending.popleft())
+
+
+def resolve_table_fingerprint(keyspace_name, table_name, future):
+    """Wait for a scheduled table fingerprint"""
+    if future is None:
+        return keyspace_name, table_name, None
+    return keyspace_name, table_name, future.result()
+
+
+def keyspace_tables(keyspace, ksp_template):
+    """ Yield (keyspace name, table, template) entries of a keyspace
+
+    A keyspace without tables yields a single entry with None table, so
+    that it still shows up in the fingerprint.
+    """
+    tables = list(keyspace.tables.values())
+    if not tables:
+        yield keyspace.name, None, None
+    for table in tables:
+        yield keyspace.name, table, ksp_template.get(table.name)
 
 
 def execute_custom_queries(session, custom_queries):
-    """prepare a list of results of custom queries"""
-    query_results = []
-    for query in custom_queries:
-        logging.debug(query)
-        result_set = session.execute(query)
-        query_results.append({
-                             "query": query,
-                             "data": [escape_row(r) for r in result_set]
-                             })
-    return query_results
+    """prepare a list of results of custom queries
 
+    Queries run one after another, in the order they are given.
+    """
+    logging.debug(custom_queries)
+    return [{"query": query, "data": list(session.execute(query))}
+            for query in custom_queries]
 
-def generate_fingerprint(host, sample_size, template_report, transient_tables,
-                         custom_queries):
-    """generate fingerprint for database"""
-    fingerprint = {}
-    cluster = cassandra.cluster.Cluster(host)
-    session = cluster.connect()
-    session.row_factory = dict_factory
-    user_keyspaces = (k for k in cluster.metadata.keyspaces.values()
-                      if not k.name.startswith('system'))
+
+_sessions = {}
+
+
+def connect(host):
+    """Open a session returning rows as dictionaries
+
+    The cluster and its session are created once per list of hosts and
+    reused by later calls.
+    """
+    key = tuple(host)
+    if key not in _sessions:
+        cluster = cassandra.cluster.Cluster(
+            host,
+            protocol_version=4,
+            compression=True,
+            executor_threads=8,
+            load_balancing_policy=TokenAwarePolicy(DCAwareRoundRobinPolicy()))
+        session = cluster.connect()
+        session.row_factory = dict_factory
+        _sessions[key] = session
+    return _sessions[key]
+
+
+def is_fingerprinted_keyspace(name, keyspaces=None):
+    """Tell if keyspace should be fingerprinted
+
+    Only keyspaces listed in keyspaces are if it is given, otherwise all
+    but internal keyspaces of Cassandra and DSE are.
+    """
+    if keyspaces is not None:
+        return name in keyspaces
+    return not (name.startswith(SKIP_KEYSPACE_PREFIXES) or
+                name in SKIP_KEYSPACES)
+
+
+def generate_fingerprint(executor, session, sample_size, template_report,
+                         transient_tables,
+                         parallel_tables=DEFAULT_PARALLEL_TABLES,
+                         keyspaces=None, concurrency=DEFAULT_CONCURRENCY):
+    """Yield (keyspace name, table name, fingerprint) of all tables
+
+    Tables are fingerprinted on executor and yielded grouped by keyspace.
+    A keyspace without tables is yielded once with None table name.
+    """
     template_keyspaces = template_report.get("keyspaces", {})
-    for space in user_keyspaces:
-        ksp_template = template_keyspaces.get(space.name, {})
-        fingerprint[space.name] = generate_fingerprint_for_kp(session, space,
-            sample_size, ksp_template, transient_tables)
-    fingerprint = {"keyspaces": fingerprint}
-    CUSTOM_QUERIES = "custom_queries"
-    if custom_queries:
-        fingerprint[CUSTOM_QUERIES] = execute_custom_queries(session,
-                                                             custom_queries)
-    if template_report and CUSTOM_QUERIES in template_report:
-        queries = [q["query"] for q in template_report[CUSTOM_QUERIES]]
-        fingerprint[CUSTOM_QUERIES] = execute_custom_queries(session, queries)
-    return fingerprint
+    tables = (entry
+              for k in session.cluster.metadata.keyspaces.values()
+              if is_fingerprinted_keyspace(k.name, keyspaces)
+              for entry in keyspace_tables(k,
+                                           template_keyspaces.get(k.name, {})))
+    yield from schedule_table_fingerprints(executor, session, tables,
+                                           sample_size, transient_tables,
+                                           2 * parallel_tables,
+                                           concurrency)
+
+
+_COLLECTIONS = (tuple, set, frozenset, SortedSet)
+_SCALARS = (int, float, bool, type(None))
+
+
+def _key(key):
+    """Return map key as string, the way JSON encoders write them"""
+    if isinstance(key, str):
+        return key
+    if isinstance(key, _SCALARS):
+        return json.dumps(key)
+    return str(key)
+
+
+def _default(value):
+    """Encode a value unknown to the serializer
+
+    Tuples, user defined types (namedtuples) and sets become lists, maps
+    become dictionaries with string keys. Anything else is stored as its
+    string form.
+    """
+    if isinstance(value, _COLLECTIONS):
+        return list(value)
+    if isinstance(value, Mapping):
+        return {_key(k): v for k, v in value.items()}
+    return str(value)
+
+
+def _without_nan(value):
+    """Return value with NaN and infinite floats replaced by None"""
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    if isinstance(value, dict):
+        return {k: _without_nan(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_without_nan(v) for v in value]
+    if isinstance(value, (_COLLECTIONS, Mapping)):
+        return _without_nan(_default(value))
+    return value
+
+
+def dump_json(value, pretty=False):
+    """Serialize value into JSON encoded bytes
+
+    Tuples and user defined types are stored as lists, other values
+    without a JSON representation (UUIDs, timestamps, blobs...) as their
+    string form.
+    """
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if pretty:
+            option |= orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS
+        try:
+            return orjson.dumps(value, default=_default, option=option)
+        except orjson.JSONEncodeError as e:
+            # e.g. varint values out of 64-bit range, json copes with them
+            logging.debug("Falling back to json: %s", e)
+    # mirror orjson: compact UTF-8, two space indent, NaN written as null
+    kwargs = {"sort_keys": True, "indent": 2} if pretty else {}
+    return json.dumps(_without_nan(value), default=_default,
+                      ensure_ascii=False,
+                      separators=(",", ":") if not pretty else None,
+                      **kwargs).encode()
+
+
+# orjson reads integers out of 64-bit range as floats, these start at
+# 19 digits (-2**63 - 1)
+_WIDE_NUMBER = re.compile(rb"\d{19}")
+
+
+def load_json(data):
+    """Deserialize JSON encoded bytes
+
+    Documents holding numbers too wide for orjson (varints) are decoded
+    by json, which keeps them exact.
+    """
+    if orjson is not None and not _WIDE_NUMBER.search(data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError as e:
+            # e.g. NaN written by json, orjson accepts strict JSON only
+            logging.debug("Falling back to json: %s", e)
+    return json.loads(data)
+
+
+def dump_msgpack(value, pretty=False):
+    """Serialize value into msgpack, unknown types as their string form
+
+    NaN is stored as None like in JSON, it never compares equal to itself.
+    """
+    return msgpack.packb(_without_nan(value), use_bin_type=True,
+                         default=_default)
+
+
+def load_msgpack(data):
+    """Deserialize msgpack encoded bytes"""
+    return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+
+def dump_cbor(value, pretty=False):
+    """Serialize value into CBOR
+
+    Unlike JSON and msgpack, UUIDs, decimals, timestamps, blobs and inet
+    addresses keep their type as CBOR tags and decode back as Python
+    objects, only types unknown to CBOR are stored as their string form.
+    Cassandra timestamps are naive datetimes in UTC. NaN is stored as None
+    like in JSON, it never compares equal to itself.
+    """
+    return cbor2.dumps(_without_nan(value), timezone=timezone.utc,
+                       default=lambda encoder, v: encoder.encode(_default(v)))
+
+
+def load_cbor(data):
+    """Deserialize CBOR encoded bytes"""
+    return cbor2.loads(data)
+
+
+# format: (module providing it, serializer, deserializer)
+FORMATS = {
+    "json": (json, dump_json, load_json),
+    "msgpack": (msgpack, dump_msgpack, load_msgpack),
+    "cbor": (cbor2, dump_cbor, load_cbor),
+}
+
+
+def write_fingerprint(stream, session, fingerprints, custom_queries, pretty,
+                      template_report=None, output_format="json"):
+    """Write fingerprint to stream as JSON, one table at a time
+
+    Pretty printed JSON is sorted and binary formats need the whole
+    document, so these are written at once instead. If template_report
+    is given, return whether the fingerprint equals it once decoded.
+    fingerprints are the (keyspace, table, fingerprint) entries yielded
+    by generate_fingerprint.
+    """
+    if pretty or output_format != "json":
+        _, dump, load = FORMATS[output_format]
+        fingerprint = {"keyspaces": {
+            ksp: {table: table_fingerprint
+                  for _, table, table_fingerprint in tables
+                  if table is not None}
+            for ksp, tables in groupby(fingerprints, key=itemgetter(0))}}
+        if custom_queries is not None:
+            fingerprint[CUSTOM_QUERIES] = execute_custom_queries(
+                session, custom_queries)
+        output = dump(fingerprint, pretty)
+        stream.write(output + b"\n" if output_format == "json" else output)
+        return (template_report is not None and
+                template_report == load(output))
+    check = template_report is not None
+    template_keyspaces = template_report.get("keyspaces", {}) if check else {}
+    same = check
+    stream.write(b'{"keyspaces":{')
+    written_keyspaces = 0
+    for ksp, tables in groupby(fingerprints, key=itemgetter(0)):
+        ksp_template = template_keyspaces.get(ksp)
+        same = same and ksp_template is not None
+        if written_keyspaces:
+            stream.write(b",")
+        stream.write(dump_json(ksp) + b":{")
+        written_keyspaces += 1
+        written_tables = 0
+        for _, table, table_fingerprint in tables:
+            if table is None:
+                continue
+            output = dump_json(table_fingerprint)
+            if written_tables:
+                stream.write(b",")
+            stream.write(dump_json(table) + b":" + output)
+            written_tables += 1
+            same = same and ksp_template.get(table) == load_json(output)
+        same = same and written_tables == len(ksp_template)
+        stream.write(b"}")
+    stream.write(b"}")
+    same = same and written_keyspaces == len(template_keyspaces)
+    if custom_queries is not None:
+        output = dump_json(execute_custom_queries(session, custom_queries))
+        stream.write(b',"' + CUSTOM_QUERIES.encode() + b'":' + output)
+        same = same and template_report.get(CUSTOM_QUERIES) == load_json(
+            output)
+    same = same and len(template_report) == 1 + (custom_queries is not None)
+    stream.write(b"}\n")
+    return same
 
 
 def run():
@@ -157,11 +458,23 @@ def run():
     parser.add_argument('-d', dest='loglevel', action='store_const',
                         const=logging.DEBUG, default=logging.INFO,
                         help='enable debug')
-    parser.add_argument('--pretty', dest='pretty', action='store_const',
-                        help='pretty print a fingerprint',
-                        default={},
-                        const={"sort_keys": True, "indent": 3}
-                        )
+    parser.add_argument('--pretty', dest='pretty', action='store_true',
+                        help='pretty print a fingerprint, JSON only')
+    parser.add_argument('-f', '--format', dest='output_format',
+                        choices=list(FORMATS), default='json',
+                        help='''format of a fingerprint and of a checked
+                        template. Binary formats are compared once decoded,
+                        not byte by byte.''')
+    parser.add_argument('-p', '--parallel-tables', type=int,
+                        default=DEFAULT_PARALLEL_TABLES, metavar='N',
+                        help='number of tables fingerprinted in parallel')
+    parser.add_argument('-c', '--concurrency', type=int,
+                        default=DEFAULT_CONCURRENCY, metavar='N',
+                        help='''maximum number of queries in flight per
+                        table. Up to PARALLEL_TABLES * N queries run at once,
+                        spread over one connection per node; with protocol
+                        v4 a connection carries up to 32768 requests, so
+                        lower N if the cluster reports overload.''')
     sp = parser.add_subparsers(title="subcommands", dest="command")
     sp.required = True
     parser_t = sp.add_parser('check',
@@ -186,31 +499,65 @@ def run():
                           help='Skip data collection for a table. Could be' +
                           ' set more than once. Format: <keyspace>.<table>'
                           )
-    parser.add_argument('host', type=str, help='address of cassandra cluster',
-                        default='127.0.0.1', nargs='?')
+    # argparse cannot match a positional following the subcommands, so
+    # every subcommand takes the host itself, keyspaces go along with it
+    for subparser in (parser_t, parser_c):
+        subparser.add_argument('-k', '--keyspace', dest='keyspaces',
+                               action='append', metavar='KEYSPACE',
+                               help='Fingerprint only this keyspace. Could' +
+                               ' be set more than once. Internal keyspaces' +
+                               ' are skipped unless listed.'
+                               )
+        subparser.add_argument('host', type=str,
+                               help='comma separated addresses of cassandra' +
+                               ' cluster nodes used as contact points',
+                               default='127.0.0.1', nargs='?')
     args = parser.parse_args()
     logging.basicConfig(format='%(asctime)s - %(levelname)s: %(message)s',
                         level=args.loglevel)
+    module, _, load = FORMATS[args.output_format]
+    if module is None:
+        parser.error(f"{args.output_format} support is not installed")
+    if args.pretty and args.output_format != "json":
+        parser.error("--pretty applies to JSON output only")
+    if args.parallel_tables < 1:
+        parser.error("--parallel-tables must be at least 1")
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
     if args.command == 'check':
-        with open(args.fingerprint, 'r') as fp:
-            template_report = json.load(fp)
-        fingerprint = generate_fingerprint([args.host], None,
-                                           template_report,
-                                           [],
-                                           None)
-        print(json.dumps(fingerprint, **args.pretty))
-        if template_report != fingerprint:
-            logging.warning("Template and database differ")
-            sys.exit(1)
+        with open(args.fingerprint, 'rb') as fp:
+            template_report = load(fp.read())
+        sample_size = None
+        transient_tables = []
+        if CUSTOM_QUERIES in template_report:
+            custom_queries = [q["query"]
+                              for q in template_report[CUSTOM_QUERIES]]
+        else:
+            custom_queries = None
     elif args.command == 'fingerprint':
-        fingerprint = generate_fingerprint([args.host], args.sample_size,
-                                           {},
-                                           args.transient_tables,
-                                           args.custom_queries
-                                           )
-        print(json.dumps(fingerprint, **args.pretty))
+        template_report = {}
+        sample_size = args.sample_size
+        transient_tables = frozenset(args.transient_tables)
+        custom_queries = args.custom_queries or None
     else:
         raise Exception("Not implemented")
+    keyspaces = args.keyspaces and frozenset(args.keyspaces)
+    session = connect([h.strip() for h in args.host.split(',') if h.strip()])
+    with ThreadPoolExecutor(max_workers=args.parallel_tables) as executor:
+        fingerprints = generate_fingerprint(executor, session, sample_size,
+                                            template_report,
+                                            transient_tables,
+                                            args.parallel_tables,
+                                            keyspaces,
+                                            args.concurrency)
+        same = write_fingerprint(sys.stdout.buffer, session, fingerprints,
+                                 custom_queries, args.pretty,
+                                 template_report if args.command == 'check'
+                                 else None,
+                                 args.output_format)
+    if args.command == 'check' and not same:
+        logging.warning("Template and database differ")
+        sys.exit(1)
 
 
 if __name__ == '__main__':